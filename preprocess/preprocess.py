@@ -1,10 +1,21 @@
 import guitarpro
 import mido
 from mido import MidiFile
-import json
+import multiprocessing
+import numpy as np
+import orjson
+import pickle
 import sys
+from operator import itemgetter
 from pathlib import Path
 
+try:
+    from numba import njit
+except ImportError:
+    # numba is optional (install with the "jit" extra); without it the
+    # note-matching kernel below simply runs as plain Python
+    njit = None
+
 DEFAULT_INPUT_DIR = Path("../data")
 DEFAULT_OUTPUT_DIR = Path("../public/data")
 
@@ -13,6 +24,25 @@ STANDARD_TUNING = [40, 45, 50, 55, 59, 64]
 
 NOTE_NAMES = ["C", "C#", "D", "D#", "E", "F", "F#", "G", "G#", "A", "A#", "B"]
 
+# Template for the per-note objects in the output JSON. Notes are collected as
+# parallel columns (one list per key) and only turned into dicts right before
+# serialization; copying this template shares its key table across all notes,
+# which is cheaper than rebuilding the keys per note. string/fret are added
+# separately since they may be omitted (see parse_gp5_and_midi).
+_NOTE_TEMPLATE = {
+    "duration": 0.0,
+    "durationTicks": 0,
+    "midi": 0,
+    "name": "",
+    "ticks": 0,
+    "time": 0.0,
+    "velocity": 0.0,
+}
+
+# Precomputed note name for every MIDI pitch (0-127), so the hot parsing loops
+# can do a single index lookup instead of formatting a string per note.
+MIDI_NAMES = tuple(f"{NOTE_NAMES[m % 12]}{m // 12 - 1}" for m in range(128))
+
 
 def midi_to_note_name(midi):
     """
@@ -22,26 +52,71 @@ def midi_to_note_name(midi):
         octave = (midi // 12) - 1
         name = NOTE_NAMES[midi % 12]
     """
-    octave = (midi // 12) - 1
-    name = NOTE_NAMES[midi % 12]
-    return f"{name}{octave}"
+    return MIDI_NAMES[midi]
 
-def parse_gp5_and_midi(input_gp5, input_midi, output_file):
-    """
-    Parses a Guitar Pro 5 file and its corresponding MIDI file, then exports combined data as JSON.
-    This is useful for extracting accurate timing from MIDI while keeping note info from GP5.
 
-    This function takes the note data from the midi file and enriches it with string and fret information from the GP5 file.
+def _match_on_off(kinds, pitches, vels, ticks):
+    """
+    Match note_on events (kind 1) to note_off events (kind 0) FIFO per pitch.
 
-    Right now, it just associates a string and fret position with every note in the MIDI file, which is not ideal. A more robust implementation would attempt to match MIDI notes to GP5 notes based on timing and pitch, but that is non-trivial and may require heuristics to handle discrepancies between the two files.
+    Takes flat per-event arrays and returns (start_ticks, end_ticks, pitch,
+    velocity) arrays for every finished note, in note_off order, plus the
+    indices of note_offs that had no pending note_on. Pure integer algorithm
+    over preallocated arrays so numba can compile it when installed.
     """
+    n = kinds.shape[0]
+    # Intrusive FIFO per pitch: head/tail point at event indices, nxt links them
+    head = np.full(128, -1, np.int64)
+    tail = np.full(128, -1, np.int64)
+    nxt = np.full(n, -1, np.int64)
+    out_start = np.empty(n, np.int64)
+    out_end = np.empty(n, np.int64)
+    out_pitch = np.empty(n, np.int16)
+    out_vel = np.empty(n, np.float64)
+    unmatched = np.empty(n, np.int64)
+    m = 0
+    u = 0
+    for i in range(n):
+        p = pitches[i]
+        if kinds[i] == 1:
+            if tail[p] == -1:
+                head[p] = i
+            else:
+                nxt[tail[p]] = i
+            tail[p] = i
+        else:
+            j = head[p]
+            if j == -1:
+                unmatched[u] = i
+                u += 1
+            else:
+                head[p] = nxt[j]
+                if head[p] == -1:
+                    tail[p] = -1
+                out_start[m] = ticks[j]
+                out_end[m] = ticks[i]
+                out_pitch[m] = p
+                out_vel[m] = vels[j]
+                m += 1
+    return out_start[:m], out_end[:m], out_pitch[:m], out_vel[:m], unmatched[:u]
 
-    ### Part 1: Create a mapping of MIDI notes from the GP5 file with their string and fret info
-    # Note: We do not record the timing from the GP5 file, as it may not be accurate. We will rely on the MIDI file for timing.
-    # Example: MIDI note C4 (60) is played on string 3 fret 5 in the GP5 file. We want to associate MIDI note 60 with string 3 fret 5.
 
+if njit is not None:
+    _match_on_off = njit(cache=True)(_match_on_off)
+
+
+def build_gp5_pitch_table(input_gp5):
+    """
+    Walk a Guitar Pro 5 file and map every MIDI pitch it plays to a (string, fret) position.
+
+    Returns a dense 128-entry list: index = midi_pitch, value = (string, fret)
+    tuple or None if the pitch never appears in the GP5.
+    """
     gp5_song = guitarpro.parse(input_gp5)
-    gp5_note_mapping = {}  # Key: (midi_pitch), Value: {string, fret}
+    gp5_pitch_table = [None] * 128
+
+    # Local alias: module-global lookups cost more than locals in the quad-nested walk
+    _tuning = STANDARD_TUNING
 
     for track in gp5_song.tracks:
         if track.isPercussionTrack:
@@ -54,18 +129,65 @@ def parse_gp5_and_midi(input_gp5, input_midi, output_file):
                         string_number = note.string
                         fret = note.value
 
-                        string_index = 6 - string_number
-                        midi_pitch = STANDARD_TUNING[string_index] + fret
+                        midi_pitch = _tuning[6 - string_number] + fret
+
+                        existing = gp5_pitch_table[midi_pitch]
+                        if existing is None:
+                            gp5_pitch_table[midi_pitch] = (string_number, fret)
+                        elif existing[0] != string_number or existing[1] != fret:
+                            # The same MIDI pitch is mapped to different string/fret positions, which indicates a potential issue
+                            print(f"Warning: MIDI pitch {midi_pitch} is mapped to multiple string/fret positions in GP5:")
+                            print(f"  Existing mapping: string {existing[0]}, fret {existing[1]}")
+                            print(f"  New mapping: string {string_number}, fret {fret}")
+
+    return gp5_pitch_table
 
-                        if midi_pitch not in gp5_note_mapping:
-                            gp5_note_mapping[midi_pitch] = {"string": string_number, "fret": fret}
-                        if midi_pitch in gp5_note_mapping:
-                            # Log only if the same MIDI pitch is mapped to different string/fret positions, which indicates a potential issue
-                            existing_mapping = gp5_note_mapping[midi_pitch]
-                            if existing_mapping["string"] != string_number or existing_mapping["fret"] != fret:
-                                print(f"Warning: MIDI pitch {midi_pitch} is mapped to multiple string/fret positions in GP5:")
-                                print(f"  Existing mapping: string {existing_mapping['string']}, fret {existing_mapping['fret']}")
-                                print(f"  New mapping: string {string_number}, fret {fret}")
+
+def parse_gp5_and_midi(input_gp5, input_midi, output_file, omit_unmapped_positions=True):
+    """
+    Parses a Guitar Pro 5 file and its corresponding MIDI file, then exports combined data as JSON.
+    This is useful for extracting accurate timing from MIDI while keeping note info from GP5.
+
+    This function takes the note data from the midi file and enriches it with string and fret information from the GP5 file.
+    Notes whose pitch never appears in the GP5 get no string/fret keys at all (smaller output); pass omit_unmapped_positions=False to emit explicit nulls instead.
+
+    Right now, it just associates a string and fret position with every note in the MIDI file, which is not ideal. A more robust implementation would attempt to match MIDI notes to GP5 notes based on timing and pitch, but that is non-trivial and may require heuristics to handle discrepancies between the two files.
+    """
+
+    # Convert to Path if string
+    if isinstance(output_file, str):
+        output_file = Path(output_file)
+    output_file.parent.mkdir(parents=True, exist_ok=True)
+
+    ### Part 1: Create a mapping of MIDI notes from the GP5 file with their string and fret info
+    # Note: We do not record the timing from the GP5 file, as it may not be accurate. We will rely on the MIDI file for timing.
+    # Example: MIDI note C4 (60) is played on string 3 fret 5 in the GP5 file. We want to associate MIDI note 60 with string 3 fret 5.
+
+    # The GP5 walk is pure-Python and dominates cold-start, so cache its result
+    # next to the output, keyed on the GP5 file's mtime and size. Re-running
+    # after editing only the MIDI file skips the GP5 parse entirely.
+    gp5_stat = Path(input_gp5).stat()
+    cache_key = (gp5_stat.st_mtime_ns, gp5_stat.st_size)
+    cache_path = output_file.with_suffix(".gp5cache.pkl")
+
+    gp5_pitch_table = None
+    if cache_path.exists():
+        try:
+            with open(cache_path, "rb") as f:
+                cached_key, cached_table = pickle.load(f)
+            if cached_key == cache_key:
+                gp5_pitch_table = cached_table
+        except (OSError, pickle.UnpicklingError, EOFError, ValueError):
+            pass  # Corrupt or stale cache; rebuild it below
+
+    if gp5_pitch_table is None:
+        gp5_pitch_table = build_gp5_pitch_table(input_gp5)
+        with open(cache_path, "wb") as f:
+            pickle.dump((cache_key, gp5_pitch_table), f)
+
+    # Lookup arrays for vectorized enrichment; -1 marks pitches absent from the GP5
+    string_lut = np.array([m[0] if m is not None else -1 for m in gp5_pitch_table], dtype=np.int16)
+    fret_lut = np.array([m[1] if m is not None else -1 for m in gp5_pitch_table], dtype=np.int16)
 
     ### Part 2: Parse the MIDI file and create the output JSON, enriching MIDI notes with string/fret info from the GP5 mapping
     midi_song = MidiFile(input_midi)
@@ -81,123 +203,134 @@ def parse_gp5_and_midi(input_gp5, input_midi, output_file):
     }
 
     for track in midi_song.tracks:
-        note_data_list = []
-        note_queue = {}  # Maps MIDI pitch -> list of pending note_on events
-        absolute_time_seconds = 0.0
+        # Flat per-event columns for the matching kernel: kind (1 = note on,
+        # 0 = note off), pitch, normalized velocity, absolute tick
+        kinds = []
+        pitches = []
+        vels = []
+        event_ticks = []
         absolute_ticks = 0
         tempo_usec = 500000  # Default tempo: 120 BPM = 500000 microseconds per beat
-        channel_percussion = set()  # Track which channels are percussion (MIDI channel 9)
+        # Piecewise tempo map: segment start tick, start second, tick -> second
+        # factor. Only ticks are accumulated per message; seconds are derived
+        # for all notes at once after matching.
+        sec_per_tick = tempo_usec / 1_000_000.0 / midi_song.ticks_per_beat
+        seg_ticks = [0]
+        seg_secs = [0.0]
+        seg_factors = [sec_per_tick]
+
+        # Bound locally to skip the attribute lookup on every event append
+        kinds_append = kinds.append
+        pitches_append = pitches.append
+        vels_append = vels.append
+        event_ticks_append = event_ticks.append
 
         for msg in track:
-            # Accumulate absolute time from delta time
-            absolute_time_seconds += mido.tick2second(msg.time, midi_song.ticks_per_beat, tempo_usec)
+            # Accumulate absolute time from delta time, in integer ticks only
             absolute_ticks += msg.time
 
-            if msg.type == "set_tempo":
+            mtype = msg.type
+            if mtype == "note_on" or mtype == "note_off":
+                # Skip percussion (MIDI channel 9) before it ever enters the stream
+                if msg.channel == 9:
+                    continue
+
+                if mtype == "note_on" and msg.velocity > 0:
+                    kinds_append(1)
+                    vels_append(msg.velocity / 127.0)
+                else:
+                    # note_off, or note_on with velocity 0 which means the same
+                    kinds_append(0)
+                    vels_append(0.0)
+                pitches_append(msg.note)
+                event_ticks_append(absolute_ticks)
+            elif mtype == "set_tempo":
+                # Close out the current tempo segment and open a new one
+                sec_at_change = seg_secs[-1] + (absolute_ticks - seg_ticks[-1]) * sec_per_tick
                 tempo_usec = msg.tempo
+                sec_per_tick = tempo_usec / 1_000_000.0 / midi_song.ticks_per_beat
+                seg_ticks.append(absolute_ticks)
+                seg_secs.append(sec_at_change)
+                seg_factors.append(sec_per_tick)
                 output["meta"]["tempo"] = mido.tempo2bpm(msg.tempo)
-            elif msg.type == "time_signature":
+            elif mtype == "time_signature":
                 output["meta"]["timeSignature"] = [msg.numerator, msg.denominator]
-            elif msg.type == "note_on":
-                if msg.velocity > 0:
-                    # Note on: store the onset
-                    midi_pitch = msg.note
-                    velocity = msg.velocity / 127.0
-                    
-                    # Track percussion channel
-                    if msg.channel == 9:
-                        channel_percussion.add(msg.channel)
-                    
-                    # Add to note queue (FIFO per pitch)
-                    if midi_pitch not in note_queue:
-                        note_queue[midi_pitch] = []
-                    note_queue[midi_pitch].append({
-                        "absolute_time": absolute_time_seconds,
-                        "absolute_ticks": absolute_ticks,
-                        "velocity": velocity,
-                        "channel": msg.channel,
-                        "midi_pitch": midi_pitch
-                    })
-                else:
-                    # note_on with velocity 0 is treated as note_off
-                    midi_pitch = msg.note
-                    if midi_pitch in note_queue and len(note_queue[midi_pitch]) > 0:
-                        note_on_data = note_queue[midi_pitch].pop(0)  # FIFO
-                        duration = absolute_time_seconds - note_on_data["absolute_time"]
-                        duration_ticks = absolute_ticks - note_on_data["absolute_ticks"]
-                        
-                        # Skip percussion channel notes
-                        if note_on_data["channel"] != 9:
-                            note_data = {
-                                "duration": duration,
-                                "durationTicks": duration_ticks,
-                                "midi": midi_pitch,
-                                "name": midi_to_note_name(midi_pitch),
-                                "ticks": note_on_data["absolute_ticks"],
-                                "time": note_on_data["absolute_time"],
-                                "velocity": note_on_data["velocity"],
-                                "string": None,  # To be filled from GP5 mapping
-                                "fret": None,    # To be filled from GP5 mapping
-                            }
-                            
-                            if midi_pitch in gp5_note_mapping:
-                                note_data["string"] = gp5_note_mapping[midi_pitch]["string"]
-                                note_data["fret"] = gp5_note_mapping[midi_pitch]["fret"]
-                            
-                            note_data_list.append(note_data)
-                    else:
-                        print(f"Warning: note_off for MIDI pitch {midi_pitch} without matching note_on")
-            elif msg.type == "note_off":
-                midi_pitch = msg.note
-                if midi_pitch in note_queue and len(note_queue[midi_pitch]) > 0:
-                    note_on_data = note_queue[midi_pitch].pop(0)  # FIFO
-                    duration = absolute_time_seconds - note_on_data["absolute_time"]
-                    duration_ticks = absolute_ticks - note_on_data["absolute_ticks"]
-                    
-                    # Skip percussion channel notes
-                    if note_on_data["channel"] != 9:
-                        note_data = {
-                            "duration": duration,
-                            "durationTicks": duration_ticks,
-                            "midi": midi_pitch,
-                            "name": midi_to_note_name(midi_pitch),
-                            "ticks": note_on_data["absolute_ticks"],
-                            "time": note_on_data["absolute_time"],
-                            "velocity": note_on_data["velocity"],
-                            "string": None,  # To be filled from GP5 mapping
-                            "fret": None,    # To be filled from GP5 mapping
-                        }
-                        
-                        if midi_pitch in gp5_note_mapping:
-                            note_data["string"] = gp5_note_mapping[midi_pitch]["string"]
-                            note_data["fret"] = gp5_note_mapping[midi_pitch]["fret"]
-                        
-                        note_data_list.append(note_data)
-                else:
-                    print(f"Warning: note_off for MIDI pitch {midi_pitch} without matching note_on")
 
-        # Sort notes by start time
-        note_data_list.sort(key=lambda note: note["time"])
-        
+        # Match note_ons to note_offs in the (optionally JIT-compiled) kernel
+        n_events = len(kinds)
+        start_ticks_arr, end_ticks_arr, pitch_arr, vel_arr, unmatched = _match_on_off(
+            np.fromiter(kinds, dtype=np.uint8, count=n_events),
+            np.fromiter(pitches, dtype=np.int16, count=n_events),
+            np.fromiter(vels, dtype=np.float64, count=n_events),
+            np.fromiter(event_ticks, dtype=np.int64, count=n_events),
+        )
+        for i in unmatched.tolist():
+            print(f"Warning: note_off for MIDI pitch {pitches[i]} without matching note_on")
+
+        # Convert ticks to seconds for all notes at once through the tempo map
+        seg_ticks_arr = np.array(seg_ticks, dtype=np.int64)
+        seg_secs_arr = np.array(seg_secs)
+        seg_factors_arr = np.array(seg_factors)
+        si = np.searchsorted(seg_ticks_arr, start_ticks_arr, side="right") - 1
+        ei = np.searchsorted(seg_ticks_arr, end_ticks_arr, side="right") - 1
+        start_times = seg_secs_arr[si] + (start_ticks_arr - seg_ticks_arr[si]) * seg_factors_arr[si]
+        end_times = seg_secs_arr[ei] + (end_ticks_arr - seg_ticks_arr[ei]) * seg_factors_arr[ei]
+
+        durations = (end_times - start_times).tolist()
+        durations_ticks = (end_ticks_arr - start_ticks_arr).tolist()
+        midis = pitch_arr.tolist()
+        names = [MIDI_NAMES[p] for p in midis]
+        ticks = start_ticks_arr.tolist()
+        times = start_times.tolist()
+        velocities = vel_arr.tolist()
+
+        # Enrich the whole track at once: a single C-level gather through the
+        # pitch LUTs replaces a per-note mapping probe (None = no GP5 mapping)
+        strings = [s if s != -1 else None for s in string_lut[pitch_arr].tolist()]
+        frets = [f if f != -1 else None for f in fret_lut[pitch_arr].tolist()]
+
+        # Assemble the per-note objects from the columns
+        note_data_list = []
+        for duration, duration_ticks, midi_pitch, name, tick, time, velocity, string, fret in zip(
+            durations, durations_ticks, midis, names, ticks, times, velocities, strings, frets
+        ):
+            note_data = _NOTE_TEMPLATE.copy()
+            note_data["duration"] = duration
+            note_data["durationTicks"] = duration_ticks
+            note_data["midi"] = midi_pitch
+            note_data["name"] = name
+            note_data["ticks"] = tick
+            note_data["time"] = time
+            note_data["velocity"] = velocity
+            if string is not None:
+                note_data["string"] = string
+                note_data["fret"] = fret
+            elif not omit_unmapped_positions:
+                note_data["string"] = None
+                note_data["fret"] = None
+            note_data_list.append(note_data)
+
+        # Sort notes by start time. Notes are appended at note_off time, so
+        # overlapping notes can finish out of start order - the sort stays.
+        note_data_list.sort(key=itemgetter("time"))
+
         output["tracks"].append({
             "name": track.name if track.name else "Unnamed Track",
             "notes": note_data_list
         })
 
-    # Convert to Path if string
-    if isinstance(output_file, str):
-        output_file = Path(output_file)
-    
-    output_file.parent.mkdir(parents=True, exist_ok=True)
-    with open(output_file, "w") as f:
-        json.dump(output, f, indent=2)
+    # The JSON is machine-consumed, so serialize compact with orjson (a C
+    # extension that emits bytes directly) and write it in one call.
+    with open(output_file, "wb", buffering=1 << 20) as f:
+        f.write(orjson.dumps(output, option=orjson.OPT_SERIALIZE_NUMPY))
     
 if __name__ == "__main__":
     if len(sys.argv) != 4:
         DEFAULT_OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
 
-        # Find all folders within the input directory. For each folder, find the .gp5 file and the .mid file regardless of their names, and parse them together. 
+        # Find all folders within the input directory. For each folder, find the .gp5 file and the .mid file regardless of their names, and parse them together.
         # Output the JSON file with the same name as the folder.
+        jobs = []
         for folder in DEFAULT_INPUT_DIR.iterdir():
             if folder.is_dir():
                 gp5_file = None
@@ -212,8 +345,13 @@ if __name__ == "__main__":
                 if gp5_file and midi_file:
                     output_file = DEFAULT_OUTPUT_DIR / (folder.name + ".json")
                     print(f"Processing folder '{folder.name}': GP5='{gp5_file.name}', MIDI='{midi_file.name}' -> Output='{output_file.name}'")
-                    parse_gp5_and_midi(gp5_file, midi_file, output_file)
+                    jobs.append((gp5_file, midi_file, output_file))
                 else:
                     print(f"Warning: Folder '{folder.name}' does not contain both a .gp5 and a .mid file. Skipping.")
+
+        # Folders are independent of each other, so preprocess them in parallel
+        if jobs:
+            with multiprocessing.Pool() as pool:
+                pool.starmap(parse_gp5_and_midi, jobs)
     else:
         parse_gp5_and_midi(Path(sys.argv[1]), Path(sys.argv[2]), Path(sys.argv[3]))
\ No newline at end of file